@@ -1,24 +1,53 @@
-import schedule
+import sched
 import time
+import bisect
 import os
 import json
+import re
 import requests
 import logging
-from subprocess import Popen, PIPE
-
-# Setup logging to file for persistent logs
-logging.basicConfig(filename='/var/log/thermohash.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+import logging.handlers
+import queue
+import atexit
+import subprocess
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson is optional; fall back to the standard library encoder/decoder when it is not installed
+try:
+    import orjson
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+# Setup logging to file for persistent logs (set THERMOHASH_LOGLEVEL=DEBUG for verbose output).
+# Records are queued and written by a background listener so slow storage never stalls a cycle.
+log_queue = queue.Queue(-1)
+file_handler = logging.handlers.RotatingFileHandler('/var/log/thermohash.log', maxBytes=5_000_000, backupCount=3, delay=True)
+file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logging.getLogger().setLevel(os.getenv("THERMOHASH_LOGLEVEL", "INFO").upper())
+logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
 
 # Load configuration from config.json
-logging.debug("Loading configuration from config.json")
+logger.debug("Loading configuration from config.json")
 try:
-    with open("config.json", "r") as config_file:
-        config = json.load(config_file)
+    with open("config.json", "rb") as config_file:
+        config = json_loads(config_file.read())
 except FileNotFoundError:
-    logging.error("Config file not found. Ensure config.json is in the script's directory.")
+    logger.error("Config file not found. Ensure config.json is in the script's directory.")
     exit(1)
 except json.JSONDecodeError:
-    logging.error("Config file is not in proper JSON format.")
+    logger.error("Config file is not in proper JSON format.")
     exit(1)
 
 # Environment-based configuration for sensitive information
@@ -33,97 +62,184 @@ TEMP_THRESHOLDS = {float(threshold): float(power) for threshold, power in config
 MAX_POWER = max(TEMP_THRESHOLDS.values())
 MIN_POWER = min(TEMP_THRESHOLDS.values())
 
-def get_current_temperature(lat, lon):
-    """Get the current temperature using Open-Meteo API."""
+# Thresholds sorted once and split into parallel lists for bisect lookups
+THRESHOLD_TEMPS, THRESHOLD_POWERS = map(list, zip(*sorted(TEMP_THRESHOLDS.items())))
+MIN_TEMP_THRESHOLD = THRESHOLD_TEMPS[0]
+MAX_TEMP_THRESHOLD = THRESHOLD_TEMPS[-1]
+
+# Open-Meteo refreshes current conditions every 15 minutes, so reuse readings within that window
+WEATHER_TTL = float(config.get("weather_cache_seconds", 900))
+weather_cache = {"temperature": None, "fetched_at": 0.0}
+
+# Request URL for the configured location, built once since the coordinates never change at runtime
+WEATHER_URL = f"https://api.open-meteo.com/v1/forecast?latitude={LATITUDE}&longitude={LONGITUDE}&current_weather=true"
+
+# Shared HTTP session so the Open-Meteo connection is kept alive between cycles
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "thermohash/1"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, connect=2, read=2, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(["GET"]))))
+
+# Background worker so miner authentication overlaps the weather request
+EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+# Login tokens are reused across cycles; a failed SetPowerTarget forces a fresh login
+TOKEN_TTL = 3000
+token_cache = {"token": None, "expires_at": 0.0}
+
+# Consecutive login failures back off exponentially (5 min doubling, capped at 1 h) instead of retrying every cycle
+AUTH_BACKOFF_BASE = 300
+AUTH_BACKOFF_MAX = 3600
+auth_backoff = {"failures": 0, "retry_at": 0.0}
+
+# Last power target applied; an unchanged target is only re-sent once POWER_REFRESH_INTERVAL has passed
+POWER_REFRESH_INTERVAL = 3600
+last_power_target = {"watts": None, "set_at": 0.0}
+
+# grpcurl argument lists built once; passing them without a shell avoids quoting issues with credentials.
+# The binary is resolved on PATH once here rather than on every call.
+GRPCURL = shutil.which("grpcurl") or "grpcurl"
+GRPC_TARGET = f"{MINER_ADDRESS}:50051"
+AUTH_COMMAND = [GRPCURL, "-plaintext", "-d", json_dumps({"username": USERNAME, "password": PASSWORD}), GRPC_TARGET, "braiins.bos.v1.AuthenticationService/Login"]
+
+# Pulls the token out of grpcurl output such as `"authorization": "<token>"` in a single pass
+TOKEN_RE = re.compile(rb'authorization"?\s*:\s*"?([^"\s,]+)', re.IGNORECASE)
+
+# grpcurl reports a rejected token as `Code: Unauthenticated` on stderr; only that error warrants a fresh login
+UNAUTHENTICATED_RE = re.compile(rb"\bUnauthenticated\b", re.IGNORECASE)
+
+def get_current_temperature():
+    """Get the current temperature at the configured location using Open-Meteo API, cached for WEATHER_TTL seconds."""
+    if weather_cache["temperature"] is not None and time.monotonic() - weather_cache["fetched_at"] < WEATHER_TTL:
+        logger.debug("Using cached temperature: %s°C", weather_cache["temperature"])
+        return weather_cache["temperature"]
+
     try:
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true"
-        response = requests.get(url, timeout=10)
+        response = SESSION.get(WEATHER_URL, timeout=(3, 5))
         response.raise_for_status()
-        data = response.json()
+        data = json_loads(response.content)
         temperature_celsius = data["current_weather"]["temperature"]
-        logging.debug(f"Temperature data retrieved: {temperature_celsius}°C")
+        logger.debug("Temperature data retrieved: %s°C", temperature_celsius)
+        weather_cache.update(temperature=float(temperature_celsius), fetched_at=time.monotonic())
         return float(temperature_celsius)
-    except requests.RequestException as e:
-        logging.error(f"Error fetching temperature data: {e}")
+    except (requests.RequestException, ValueError) as e:
+        logger.error("Error fetching temperature data: %s", e)
         return None
 
+def run_grpcurl(args):
+    """Run grpcurl without a shell and return (returncode, stdout, stderr)."""
+    try:
+        result = subprocess.run(args, capture_output=True, timeout=30)
+    except subprocess.TimeoutExpired:
+        # The exception text includes the argument list (credentials/token), so report a fixed message instead
+        return -1, b"", b"grpcurl timed out after 30s"
+    except OSError as e:
+        return -1, b"", f"{e.filename or 'grpcurl'}: {e.strerror}".encode()
+    return result.returncode, result.stdout, result.stderr
+
 def authenticate():
-    """Authenticate and retrieve session token."""
-    logging.debug(f"Authenticating with the miner at {MINER_ADDRESS}")
-    auth_command = f'grpcurl -plaintext -d \'{{"username":"{USERNAME}","password":"{PASSWORD}"}}\' {MINER_ADDRESS}:50051 braiins.bos.v1.AuthenticationService/Login'
-
-    process = Popen(auth_command, shell=True, stdout=PIPE, stderr=PIPE)
-    output, error = process.communicate()
-
-    if process.returncode == 0:
-        for line in output.decode().split('\n'):
-            if "authorization" in line:
-                token = line.split(": ")[1].strip()
-                logging.debug(f"Authentication successful. Token: {token}")
-                return token
+    """Authenticate and retrieve session token, reusing the cached token while it is valid."""
+    if token_cache["token"] and time.monotonic() < token_cache["expires_at"]:
+        logger.debug("Reusing cached authentication token.")
+        return token_cache["token"]
+
+    if time.monotonic() < auth_backoff["retry_at"]:
+        logger.warning("Skipping authentication after %s consecutive failures; backing off.", auth_backoff["failures"])
+        return None
+
+    logger.debug("Authenticating with the miner at %s", MINER_ADDRESS)
+    returncode, output, error = run_grpcurl(AUTH_COMMAND)
+
+    if returncode == 0:
+        match = TOKEN_RE.search(output)
+        if match:
+            token = match.group(1).decode(errors="replace")
+            logger.debug("Authentication successful; token cached for %s seconds.", TOKEN_TTL)
+            token_cache.update(token=token, expires_at=time.monotonic() + TOKEN_TTL)
+            auth_backoff.update(failures=0, retry_at=0.0)
+            return token
     else:
-        logging.error(f"Authentication failed: {error.decode()}")
+        logger.error("Authentication failed: %s", error.decode(errors="replace").strip())
+    auth_backoff["failures"] += 1
+    auth_backoff["retry_at"] = time.monotonic() + min(AUTH_BACKOFF_MAX, AUTH_BACKOFF_BASE * 2 ** (auth_backoff["failures"] - 1))
     return None
 
 def set_power_target(power_target, token):
-    """Set the miner's power target using grpcurl."""
-    logging.debug(f"Setting power target to {power_target} watts for the miner.")
-    set_command = f'grpcurl -plaintext -H "authorization:{token}" -d \'{{"power_target":{{"watt":"{power_target}"}},"save_action":2}}\' {MINER_ADDRESS}:50051 braiins.bos.v1.PerformanceService/SetPowerTarget'
+    """Set the miner's power target using grpcurl. Returns "ok", "unauthenticated" or "failed"."""
+    logger.debug("Setting power target to %s watts for the miner.", power_target)
+    payload = json_dumps({"power_target": {"watt": str(power_target)}, "save_action": 2})
+    set_command = [GRPCURL, "-plaintext", "-H", f"authorization:{token}", "-d", payload, GRPC_TARGET, "braiins.bos.v1.PerformanceService/SetPowerTarget"]
 
-    process = Popen(set_command, shell=True, stdout=PIPE, stderr=PIPE)
-    _, error = process.communicate()
+    returncode, _, error = run_grpcurl(set_command)
 
-    if process.returncode == 0:
-        logging.info(f"Power target successfully set to {power_target} watts.")
-    else:
-        logging.error(f"Failed to set power target. Error: {error.decode()}")
+    if returncode == 0:
+        logger.info("Power target successfully set to %s watts.", power_target)
+        last_power_target.update(watts=power_target, set_at=time.monotonic())
+        return "ok"
+    logger.error("Failed to set power target. Error: %s", error.decode(errors="replace").strip())
+    return "unauthenticated" if UNAUTHENTICATED_RE.search(error) else "failed"
 
 def adjust_power_based_on_weather():
     """Adjust power setting based on the current temperature."""
-    logging.debug(f"Adjusting power based on current temperature at ({LATITUDE}, {LONGITUDE})")
-    temperature = get_current_temperature(LATITUDE, LONGITUDE)
+    logger.debug("Adjusting power based on current temperature at (%s, %s)", LATITUDE, LONGITUDE)
+    token_was_cached = token_cache["token"] is not None and time.monotonic() < token_cache["expires_at"]
+    # Only log in ahead of the weather request when this cycle is certain to send a target
+    refresh_due = last_power_target["watts"] is None or time.monotonic() - last_power_target["set_at"] >= POWER_REFRESH_INTERVAL
+    auth_future = EXECUTOR.submit(authenticate) if refresh_due else None
+    temperature = get_current_temperature()
 
     if temperature is None:
-        logging.error("Could not retrieve temperature data. Skipping power adjustment.")
+        logger.error("Could not retrieve temperature data. Skipping power adjustment.")
         return
 
     power_target = None
-    if temperature <= min(TEMP_THRESHOLDS):
+    if temperature <= MIN_TEMP_THRESHOLD:
         power_target = MIN_POWER
-        logging.debug(f"Temperature {temperature}°C is below the lowest threshold. Setting power to minimum: {MIN_POWER} watts.")
-    elif temperature >= max(TEMP_THRESHOLDS):
+        logger.debug("Temperature %s°C is below the lowest threshold. Setting power to minimum: %s watts.", temperature, MIN_POWER)
+    elif temperature >= MAX_TEMP_THRESHOLD:
         power_target = MAX_POWER
-        logging.debug(f"Temperature {temperature}°C is above the highest threshold. Setting power to maximum: {MAX_POWER} watts.")
+        logger.debug("Temperature %s°C is above the highest threshold. Setting power to maximum: %s watts.", temperature, MAX_POWER)
     else:
-        for threshold, power in sorted(TEMP_THRESHOLDS.items()):
-            if temperature <= threshold:
-                power_target = power
-                logging.debug(f"Temperature {temperature}°C is below or equal to {threshold}°C, setting power to {power_target} watts")
-                break
+        i = bisect.bisect_left(THRESHOLD_TEMPS, temperature)
+        power_target = THRESHOLD_POWERS[i]
+        logger.debug("Temperature %s°C is below or equal to %s°C, setting power to %s watts", temperature, THRESHOLD_TEMPS[i], power_target)
 
     if power_target is not None:
-        token = authenticate()
-        if token:
-            set_power_target(power_target, token)
-        else:
-            logging.error("Authentication failed, cannot set power target.")
+        if power_target == last_power_target["watts"] and time.monotonic() - last_power_target["set_at"] < POWER_REFRESH_INTERVAL:
+            logger.debug("Power target unchanged at %s watts, skipping update.", power_target)
+            return
+        token = auth_future.result() if auth_future else authenticate()
+        status = set_power_target(power_target, token) if token else None
+        if status == "unauthenticated" and token_was_cached:
+            # The miner rejected a token from an earlier cycle; log in again and retry once
+            token_cache["token"] = None
+            token = authenticate()
+            if token:
+                set_power_target(power_target, token)
+        if not token:
+            logger.error("Authentication failed, cannot set power target.")
     else:
-        logging.error("No valid power target found for the current temperature.")
+        logger.error("No valid power target found for the current temperature.")
 
 # Execute immediately when the script starts
-logging.info("Script started, tuning the miner immediately.")
+logger.info("Script started, tuning the miner immediately.")
 adjust_power_based_on_weather()
 
-# Schedule the task to run every 10 minutes
-schedule.every(10).minutes.do(adjust_power_based_on_weather)
+# Schedule the task to run every 10 minutes on the monotonic clock
+ADJUST_INTERVAL = 600
+scheduler = sched.scheduler(time.monotonic, time.sleep)
+
+def run_and_reschedule():
+    """Queue the next adjustment, then adjust power for this cycle."""
+    scheduler.enter(ADJUST_INTERVAL, 1, run_and_reschedule)
+    adjust_power_based_on_weather()
+
+scheduler.enter(ADJUST_INTERVAL, 1, run_and_reschedule)
 
 # Run the scheduler
-logging.info("Scheduler running, will adjust power every 10 minutes.")
+logger.info("Scheduler running, will adjust power every 10 minutes.")
 try:
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    scheduler.run()
 except KeyboardInterrupt:
-    logging.info("Script stopped manually.")
+    logger.info("Script stopped manually.")
 except Exception as e:
-    logging.error(f"An unexpected error occurred: {e}")
+    logger.error("An unexpected error occurred: %s", e)
@@ -1,17 +1,47 @@
-import schedule
+import sched
 import time
+import bisect
 import os
 import json
+import re
 import requests
 import logging
+import logging.handlers
+import queue
+import atexit
+import subprocess
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Setup logging for very verbose output
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+# orjson is optional; fall back to the standard library encoder/decoder when it is not installed
+try:
+    import orjson
+    json_loads = orjson.loads
+
+    def json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+# Setup logging (set THERMOHASH_LOGLEVEL=DEBUG for very verbose output).
+# Records are queued and written to the console by a background listener so a slow console never stalls a cycle.
+log_queue = queue.Queue(-1)
+console_handler = logging.StreamHandler()
+console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+logging.getLogger().setLevel(os.getenv("THERMOHASH_LOGLEVEL", "INFO").upper())
+logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, console_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger = logging.getLogger(__name__)
 
 # Load configuration from config.json
-logging.debug("Loading configuration from config.json")
-with open("config.json", "r") as config_file:
-    config = json.load(config_file)
+logger.debug("Loading configuration from config.json")
+with open("config.json", "rb") as config_file:
+    config = json_loads(config_file.read())
 
 LATITUDE = float(config["latitude"])
 LONGITUDE = float(config["longitude"])
@@ -26,90 +56,188 @@ TEMP_THRESHOLDS = {float(threshold): float(power) for threshold, power in config
 MAX_POWER = max(TEMP_THRESHOLDS.values())
 MIN_POWER = min(TEMP_THRESHOLDS.values())
 
-# Function to get the current temperature using Open-Meteo API
-def get_current_temperature(lat, lon):
-    logging.debug(f"Fetching current temperature for coordinates: {lat}, {lon}")
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&current_weather=true"
-    response = requests.get(url)
-    data = response.json()
-    temperature_celsius = data["current_weather"]["temperature"]  # Temperature in Celsius
-    logging.debug(f"Temperature data retrieved: {temperature_celsius}°C")
-    return float(temperature_celsius)
-
-# Function to authenticate and get the session token
+# Thresholds sorted once and split into parallel lists for bisect lookups
+THRESHOLD_TEMPS, THRESHOLD_POWERS = map(list, zip(*sorted(TEMP_THRESHOLDS.items())))
+MIN_TEMP_THRESHOLD = THRESHOLD_TEMPS[0]
+MAX_TEMP_THRESHOLD = THRESHOLD_TEMPS[-1]
+
+# Open-Meteo refreshes current conditions every 15 minutes, so reuse readings within that window
+WEATHER_TTL = float(config.get("weather_cache_seconds", 900))
+weather_cache = {"temperature": None, "fetched_at": 0.0}
+
+# Request URL for the configured location, built once since the coordinates never change at runtime
+WEATHER_URL = f"https://api.open-meteo.com/v1/forecast?latitude={LATITUDE}&longitude={LONGITUDE}&current_weather=true"
+
+# Shared HTTP session so the Open-Meteo connection is kept alive between cycles
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "thermohash/1"})
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, connect=2, read=2, backoff_factor=0.2, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=frozenset(["GET"]))))
+
+# Background worker so miner authentication overlaps the weather request
+EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+# Login tokens are reused across cycles; a failed SetPowerTarget forces a fresh login
+TOKEN_TTL = 3000
+token_cache = {"token": None, "expires_at": 0.0}
+
+# Consecutive login failures back off exponentially (5 min doubling, capped at 1 h) instead of retrying every cycle
+AUTH_BACKOFF_BASE = 300
+AUTH_BACKOFF_MAX = 3600
+auth_backoff = {"failures": 0, "retry_at": 0.0}
+
+# Last power target applied; an unchanged target is only re-sent once POWER_REFRESH_INTERVAL has passed
+POWER_REFRESH_INTERVAL = 3600
+last_power_target = {"watts": None, "set_at": 0.0}
+
+# grpcurl argument lists built once; passing them without a shell avoids quoting issues with credentials.
+# The binary is resolved on PATH once here rather than on every call.
+GRPCURL = shutil.which("grpcurl") or "grpcurl"
+GRPC_TARGET = f"{MINER_ADDRESS}:50051"
+AUTH_COMMAND = [GRPCURL, "-plaintext", "-d", json_dumps({"username": USERNAME, "password": PASSWORD}), GRPC_TARGET, "braiins.bos.v1.AuthenticationService/Login"]
+
+# Pulls the token out of grpcurl output such as `"authorization": "<token>"` in a single pass
+TOKEN_RE = re.compile(rb'authorization"?\s*:\s*"?([^"\s,]+)', re.IGNORECASE)
+
+# grpcurl reports a rejected token as `Code: Unauthenticated` on stderr; only that error warrants a fresh login
+UNAUTHENTICATED_RE = re.compile(rb"\bUnauthenticated\b", re.IGNORECASE)
+
+# Function to get the current temperature at the configured location using Open-Meteo API (cached for WEATHER_TTL seconds, None on failure)
+def get_current_temperature():
+    if weather_cache["temperature"] is not None and time.monotonic() - weather_cache["fetched_at"] < WEATHER_TTL:
+        logger.debug("Using cached temperature: %s°C", weather_cache["temperature"])
+        return weather_cache["temperature"]
+
+    logger.debug("Fetching current temperature for coordinates: %s, %s", LATITUDE, LONGITUDE)
+    try:
+        response = SESSION.get(WEATHER_URL, timeout=(3, 5))
+        response.raise_for_status()
+        data = json_loads(response.content)
+        temperature_celsius = data["current_weather"]["temperature"]  # Temperature in Celsius
+        logger.debug("Temperature data retrieved: %s°C", temperature_celsius)
+        weather_cache.update(temperature=float(temperature_celsius), fetched_at=time.monotonic())
+        return float(temperature_celsius)
+    except (requests.RequestException, ValueError) as e:
+        logger.error("Error fetching temperature data: %s", e)
+        return None
+
+# Function to run grpcurl without a shell and return (returncode, stdout, stderr)
+def run_grpcurl(args):
+    try:
+        result = subprocess.run(args, capture_output=True, timeout=30)
+    except subprocess.TimeoutExpired:
+        # The exception text includes the argument list (credentials/token), so report a fixed message instead
+        return -1, b"", b"grpcurl timed out after 30s"
+    except OSError as e:
+        return -1, b"", f"{e.filename or 'grpcurl'}: {e.strerror}".encode()
+    return result.returncode, result.stdout, result.stderr
+
+# Function to authenticate and get the session token (reused while still valid)
 def authenticate():
-    logging.debug(f"Authenticating with the miner at {MINER_ADDRESS}")
-    # Properly format the grpcurl command with correct JSON formatting for username and password
-    auth_command = f'grpcurl -plaintext -d \'{{"username":"{USERNAME}","password":"{PASSWORD}"}}\' {MINER_ADDRESS}:50051 braiins.bos.v1.AuthenticationService/Login'
-    logging.debug(f"Running command: {auth_command}")
-    
-    stream = os.popen(auth_command)
-    output = stream.read()
-
-    logging.debug(f"Authentication output: {output}")
-    token_line = [line for line in output.split('\n') if "authorization" in line]
-    
-    if token_line:
-        token = token_line[0].split(": ")[1].strip()
-        logging.debug(f"Authentication successful. Token: {token}")
+    if token_cache["token"] and time.monotonic() < token_cache["expires_at"]:
+        logger.debug("Reusing cached authentication token.")
+        return token_cache["token"]
+
+    if time.monotonic() < auth_backoff["retry_at"]:
+        logger.warning("Skipping authentication after %s consecutive failures; backing off.", auth_backoff["failures"])
+        return None
+
+    logger.debug("Authenticating with the miner at %s", MINER_ADDRESS)
+    logger.debug("Calling braiins.bos.v1.AuthenticationService/Login on %s", GRPC_TARGET)
+    result, output, error = run_grpcurl(AUTH_COMMAND)
+
+    match = TOKEN_RE.search(output) if result == 0 else None
+
+    if match:
+        token = match.group(1).decode(errors="replace")
+        logger.debug("Authentication successful; token cached for %s seconds.", TOKEN_TTL)
+        token_cache.update(token=token, expires_at=time.monotonic() + TOKEN_TTL)
+        auth_backoff.update(failures=0, retry_at=0.0)
         return token
+    if result != 0:
+        logger.error("Failed to authenticate. Command exited with code %s: %s", result, error.decode(errors="replace").strip())
     else:
-        logging.error("Failed to authenticate. No token received.")
-        return None
+        logger.error("Failed to authenticate. No token received.")
+    auth_backoff["failures"] += 1
+    auth_backoff["retry_at"] = time.monotonic() + min(AUTH_BACKOFF_MAX, AUTH_BACKOFF_BASE * 2 ** (auth_backoff["failures"] - 1))
+    return None
 
-# Function to set the miner's power target using grpcurl
+# Function to set the miner's power target using grpcurl (returns "ok", "unauthenticated" or "failed")
 def set_power_target(power_target, token):
-    logging.debug(f"Setting power target to {power_target} watts for the miner.")
-    # Properly format the grpcurl command with the authorization token and power target
-    set_command = f'grpcurl -plaintext -H "authorization:{token}" -d \'{{"power_target":{{"watt":"{power_target}"}},"save_action":2}}\' {MINER_ADDRESS}:50051 braiins.bos.v1.PerformanceService/SetPowerTarget'
-    logging.debug(f"Running command: {set_command}")
-    
-    result = os.system(set_command)
+    logger.debug("Setting power target to %s watts for the miner.", power_target)
+    # Build the grpcurl arguments with the authorization token and power target
+    payload = json_dumps({"power_target": {"watt": str(power_target)}, "save_action": 2})
+    set_command = [GRPCURL, "-plaintext", "-H", f"authorization:{token}", "-d", payload, GRPC_TARGET, "braiins.bos.v1.PerformanceService/SetPowerTarget"]
+    logger.debug("Calling braiins.bos.v1.PerformanceService/SetPowerTarget on %s", GRPC_TARGET)
+
+    result, _, error = run_grpcurl(set_command)
     if result == 0:
-        logging.info(f"Power target successfully set to {power_target} watts.")
-    else:
-        logging.error(f"Failed to set power target. Command exited with code {result}.")
+        logger.info("Power target successfully set to %s watts.", power_target)
+        last_power_target.update(watts=power_target, set_at=time.monotonic())
+        return "ok"
+    logger.error("Failed to set power target. Command exited with code %s: %s", result, error.decode(errors="replace").strip())
+    return "unauthenticated" if UNAUTHENTICATED_RE.search(error) else "failed"
 
 # Function to adjust power based on temperature
 def adjust_power_based_on_weather():
-    logging.debug(f"Adjusting power based on current temperature at ({LATITUDE}, {LONGITUDE})")
-    temperature = get_current_temperature(LATITUDE, LONGITUDE)
-    logging.info(f"Current temperature at ({LATITUDE}, {LONGITUDE}): {temperature}°C")
+    logger.debug("Adjusting power based on current temperature at (%s, %s)", LATITUDE, LONGITUDE)
+    token_was_cached = token_cache["token"] is not None and time.monotonic() < token_cache["expires_at"]
+    # A target is always sent once the refresh interval is due, so start authenticating while the weather request is in flight.
+    # Otherwise the cycle may skip SetPowerTarget, and logging in is deferred until a changed target is known.
+    refresh_due = last_power_target["watts"] is None or time.monotonic() - last_power_target["set_at"] >= POWER_REFRESH_INTERVAL
+    auth_future = EXECUTOR.submit(authenticate) if refresh_due else None
+    temperature = get_current_temperature()
+    if temperature is None:
+        logger.error("Could not retrieve temperature data. Skipping power adjustment.")
+        return
+    logger.info("Current temperature at (%s, %s): %s°C", LATITUDE, LONGITUDE, temperature)
 
     # Determine the appropriate power target based on the temperature thresholds
     power_target = None
-    if temperature <= min(TEMP_THRESHOLDS):
+    if temperature <= MIN_TEMP_THRESHOLD:
         power_target = MIN_POWER  # Set to minimum power if below lowest threshold
-        logging.debug(f"Temperature {temperature}°C is below the lowest threshold. Setting power to minimum: {MIN_POWER} watts.")
-    elif temperature >= max(TEMP_THRESHOLDS):
+        logger.debug("Temperature %s°C is below the lowest threshold. Setting power to minimum: %s watts.", temperature, MIN_POWER)
+    elif temperature >= MAX_TEMP_THRESHOLD:
         power_target = MAX_POWER  # Set to maximum power if above highest threshold
-        logging.debug(f"Temperature {temperature}°C is above the highest threshold. Setting power to maximum: {MAX_POWER} watts.")
+        logger.debug("Temperature %s°C is above the highest threshold. Setting power to maximum: %s watts.", temperature, MAX_POWER)
     else:
-        for threshold, power in sorted(TEMP_THRESHOLDS.items()):
-            if temperature <= threshold:
-                power_target = power
-                logging.debug(f"Temperature {temperature}°C is below or equal to {threshold}°C, setting power to {power_target} watts")
-                break
+        i = bisect.bisect_left(THRESHOLD_TEMPS, temperature)
+        power_target = THRESHOLD_POWERS[i]
+        logger.debug("Temperature %s°C is below or equal to %s°C, setting power to %s watts", temperature, THRESHOLD_TEMPS[i], power_target)
 
     if power_target is not None:
-        # Authenticate to get the token
-        token = authenticate()
-        if token:
-            set_power_target(power_target, token)
-        else:
-            logging.error("No token available, cannot set power target.")
+        if power_target == last_power_target["watts"] and time.monotonic() - last_power_target["set_at"] < POWER_REFRESH_INTERVAL:
+            logger.debug("Power target unchanged at %s watts, skipping update.", power_target)
+            return
+        # Wait for the token requested at the start of the cycle, or log in now
+        token = auth_future.result() if auth_future else authenticate()
+        status = set_power_target(power_target, token) if token else None
+        if status == "unauthenticated" and token_was_cached:
+            # The miner rejected a token from an earlier cycle; log in again and retry once
+            token_cache["token"] = None
+            token = authenticate()
+            if token:
+                set_power_target(power_target, token)
+        if not token:
+            logger.error("No token available, cannot set power target.")
     else:
-        logging.error("No valid power target found for the current temperature.")
+        logger.error("No valid power target found for the current temperature.")
 
 # Execute the function immediately when the script starts
-logging.info("Script started, tuning the miner immediately.")
+logger.info("Script started, tuning the miner immediately.")
 adjust_power_based_on_weather()
 
-# Schedule the task to run every 10 minutes
-schedule.every(10).minutes.do(adjust_power_based_on_weather)
+# Schedule the task to run every 10 minutes on the monotonic clock
+ADJUST_INTERVAL = 600
+scheduler = sched.scheduler(time.monotonic, time.sleep)
+
+# Function to queue the next adjustment, then adjust power for this cycle
+def run_and_reschedule():
+    scheduler.enter(ADJUST_INTERVAL, 1, run_and_reschedule)
+    adjust_power_based_on_weather()
+
+scheduler.enter(ADJUST_INTERVAL, 1, run_and_reschedule)
 
 # Run the scheduler
-logging.info("Scheduler running, will adjust power every 10 minutes.")
-while True:
-    schedule.run_pending()
-    time.sleep(1)
+logger.info("Scheduler running, will adjust power every 10 minutes.")
+scheduler.run()
+